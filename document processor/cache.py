@@ -0,0 +1,66 @@
+# cache.py
+import os
+import mmap
+import orjson
+import sqlite3
+import hashlib
+
+# The cache lives next to the sorted files, e.g. sorted_documents/.cache.sqlite
+CACHE_FILENAME = '.cache.sqlite'
+
+def hash_file(file_path):
+    """
+    Returns a short BLAKE2b hex digest of the file's contents. The file is memory-mapped,
+    so a large image is hashed straight from the page cache without copying it into Python.
+    """
+    with open(file_path, 'rb') as f:
+        # mmap can't map an empty file
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.blake2b(digest_size=16).hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.blake2b(mm, digest_size=16).hexdigest()
+
+def load_file(file_path):
+    """
+    Reads the whole file and returns (data, hash), so the same bytes can be
+    used for the cache key and for the API request.
+    """
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    return data, hashlib.blake2b(data, digest_size=16).hexdigest()
+
+class ResultCache:
+    """
+    Stores Gemini analysis results keyed by the hash of the image contents,
+    so an image that is dropped in again is not sent to the API a second time.
+    """
+    def __init__(self, output_dir):
+        """
+        Opens (and creates if needed) the cache database.
+
+        Args:
+            output_dir (str): The directory for processed output, where the cache file is kept.
+        """
+        self.path = os.path.join(output_dir, CACHE_FILENAME)
+        self._conn = sqlite3.connect(self.path)
+        # WAL lets the watcher and a manual run use the same cache at the same time
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cache (hash TEXT PRIMARY KEY, result TEXT)")
+        self._conn.commit()
+
+    def get(self, file_hash):
+        """Returns the cached result dict for a hash, or None on a miss."""
+        row = self._conn.execute("SELECT result FROM cache WHERE hash=?", (file_hash,)).fetchone()
+        return orjson.loads(row[0]) if row else None
+
+    def put(self, file_hash, result):
+        """Stores the result dict for a hash, replacing any older entry."""
+        self._conn.execute(
+            "INSERT OR REPLACE INTO cache (hash, result) VALUES (?, ?)",
+            (file_hash, orjson.dumps(result).decode())
+        )
+        self._conn.commit()
+
+    def close(self):
+        """Closes the database connection."""
+        self._conn.close()
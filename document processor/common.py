@@ -0,0 +1,154 @@
+# common.py
+import io
+import os
+import re
+import time
+import random
+import shutil
+import asyncio
+import threading
+import mimetypes
+import google.generativeai as genai
+from google.api_core.exceptions import ResourceExhausted, ServiceUnavailable, DeadlineExceeded
+from PIL import Image, ImageOps
+
+# Images up to this size are sent inline with the request instead of via the File API.
+# Inline bytes are base64-encoded (4 bytes for every 3), so this leaves a 20 MB request
+# room for the encoding and the prompt.
+MAX_INLINE_BYTES = 14 * 1024 * 1024
+
+# Images are downscaled to this many pixels on the long edge before sending (see --no-resize).
+# That is plenty to read serial numbers, and JPEG at this quality is fine for OCR.
+MAX_IMAGE_EDGE = 1600
+JPEG_QUALITY = 82
+
+# Matches what str.isalnum() rejects (non-word characters and underscore); stripped from serial numbers
+NON_ALNUM = re.compile(r'[\W_]+')
+
+# Transient API errors worth retrying with backoff; anything else (e.g. InvalidArgument) fails right away
+RETRYABLE_ERRORS = (ResourceExhausted, ServiceUnavailable, DeadlineExceeded)
+MAX_ATTEMPTS = 3
+
+def is_image(file_path):
+    """Returns True if the file's name says it is an image."""
+    mime_type, _ = mimetypes.guess_type(file_path)
+    return bool(mime_type) and mime_type.startswith("image/")
+
+def is_sortable(result):
+    """Returns True if a result has a usable document type and serial number."""
+    return bool(result) and result.get('documentType', 'Unknown') != 'Unknown' and result.get('serialNumber', 'N/A') != 'N/A'
+
+def prepare_image(data, mime_type, resize=True):
+    """
+    Returns the image bytes and mime type to send to Gemini. With resize on, images whose
+    long edge is over MAX_IMAGE_EDGE are downscaled and re-encoded as JPEG to cut upload size.
+    """
+    if resize:
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                if max(img.size) > MAX_IMAGE_EDGE:
+                    # Apply the EXIF rotation first, since re-encoding drops the EXIF tag
+                    img = ImageOps.exif_transpose(img)
+                    img.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.LANCZOS)
+                    buffer = io.BytesIO()
+                    img.convert("RGB").save(buffer, "JPEG", quality=JPEG_QUALITY, optimize=True)
+                    return buffer.getvalue(), "image/jpeg"
+        except (OSError, Image.DecompressionBombError):
+            # Pillow can't decode this format, or refuses a scan this large; send the original bytes instead
+            pass
+    return data, mime_type
+
+def fast_move(src, dst):
+    """
+    Moves a file with a single rename when src and dst are on the same filesystem,
+    falling back to shutil.move (copy and delete) when they aren't.
+    """
+    try:
+        os.rename(src, dst)
+    except OSError:
+        shutil.move(src, dst)
+
+class RateLimiter:
+    """
+    Spaces out API requests so that no more than rpm of them start in any minute.
+    Safe to share between threads.
+    """
+    def __init__(self, rpm=None):
+        """
+        Args:
+            rpm (int): Requests allowed per minute, or None for no limit.
+        """
+        self.interval = 60.0 / rpm if rpm else 0.0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def acquire(self):
+        """Blocks until the next request is allowed to start."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._next:
+                time.sleep(self._next - now)
+            self._next = max(now, self._next) + self.interval
+
+class AsyncRateLimiter:
+    """The asyncio version of RateLimiter, for requests made from one event loop."""
+    def __init__(self, rpm=None):
+        """
+        Args:
+            rpm (int): Requests allowed per minute, or None for no limit.
+        """
+        self.interval = 60.0 / rpm if rpm else 0.0
+        self._lock = asyncio.Lock()
+        self._next = 0.0
+
+    async def acquire(self):
+        """Waits until the next request is allowed to start."""
+        async with self._lock:
+            now = time.monotonic()
+            if now < self._next:
+                await asyncio.sleep(self._next - now)
+            self._next = max(now, self._next) + self.interval
+
+def _retry_delay(attempt, error):
+    """Returns how long to wait before the next attempt (about 1s, then 2s) and reports the error."""
+    delay = 2 ** attempt + random.random() * 0.5
+    print(f"  -> API error ({error.__class__.__name__}), retrying in {delay:.1f}s...")
+    return delay
+
+def generate_with_retry(model, contents, limiter=None):
+    """
+    Calls Gemini, retrying rate-limit and availability errors with exponential backoff
+    before giving up. If a RateLimiter is given, every attempt, retries included, waits
+    for its turn.
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            return model.generate_content(
+                contents,
+                generation_config=genai.types.GenerationConfig(
+                    response_mime_type="application/json"
+                )
+            )
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            time.sleep(_retry_delay(attempt, e))
+
+async def generate_with_retry_async(model, contents, limiter=None):
+    """The asyncio version of generate_with_retry(), taking an AsyncRateLimiter."""
+    for attempt in range(MAX_ATTEMPTS):
+        if limiter is not None:
+            await limiter.acquire()
+        try:
+            return await model.generate_content_async(
+                contents,
+                generation_config=genai.types.GenerationConfig(
+                    response_mime_type="application/json"
+                )
+            )
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(_retry_delay(attempt, e))
@@ -1,14 +1,35 @@
 import os
-import shutil
 import argparse
-import json
+import orjson
 import mimetypes
 import google.generativeai as genai
 from dotenv import load_dotenv
 
+import cache
+from common import (
+    MAX_INLINE_BYTES, NON_ALNUM, RateLimiter, fast_move, generate_with_retry, is_image, is_sortable,
+    prepare_image
+)
+
 # Load environment variables from a .env file
 load_dotenv()
 
+# Created once by setup_gemini() and shared by every analysis call
+_MODEL = None
+
+_PROMPT = """
+    Analyze the provided document image. Your task is to classify the document and extract its serial number and the site where it has been issued.
+    site will be handwritten in feild or a space or a box designated for writing.it is usually with names of ATR,MRS,WTP,STP ,NSTP,KOY,KOD,PY and also accomponied by number such as 60,54,120,110,48 do also note that
+    The possible document types are: 'Receipt Memo', 'Cement Issue', 'Diesel Issue', 'Goods Received Note', 'Oil Issue', 'Delivery Challan', or 'Unknown'.
+    The serial number should be the most prominent identification number on the form.
+    - For 'Goods Received Note', use the 'GRN No.'.
+    - For 'Delivery Challan', use the number after '(MTS)'.
+    - For 'Diesel Receipt & Issue', use 'S.No.'.
+    - For 'Receipt Memo', find the main memo number (e.g., 58653).
+    - If no clear serial number is found, use the value 'N/A'.
+    Please return a single, raw JSON object with three keys: "documentType" , "serialNumber" and "site". Do not add any extra text, formatting, or markdown.
+    """
+
 def setup_gemini():
     """Configures the Gemini API with the key from environment variables."""
     api_key = os.getenv("API_KEY")
@@ -18,48 +39,58 @@ def setup_gemini():
         exit(1)
     genai.configure(api_key=api_key)
 
-def analyze_document_image(file_path):
+    global _MODEL
+    _MODEL = genai.GenerativeModel('gemini-2.5-flash')
+
+def analyze_document_image(file_path, result_cache=None, resize=True, limiter=None):
     """
     Analyzes a document image using the Gemini API to get its type and serial number.
+    If a result_cache is given, an image seen before is answered from the cache instead.
+    Every API attempt waits for limiter (a RateLimiter), if given.
     """
     print(f"Analyzing {os.path.basename(file_path)}...")
     try:
-        model = genai.GenerativeModel('gemini-2.5-flash')
-
-        prompt = """
-        Analyze the provided document image. Your task is to classify the document and extract its serial number and the site where it has been issued.
-        site will be handwritten in feild or a space or a box designated for writing.it is usually with names of ATR,MRS,WTP,STP ,NSTP,KOY,KOD,PY and also accomponied by number such as 60,54,120,110,48 do also note that
-        The possible document types are: 'Receipt Memo', 'Cement Issue', 'Diesel Issue', 'Goods Received Note', 'Oil Issue', 'Delivery Challan', or 'Unknown'.
-        The serial number should be the most prominent identification number on the form.
-        - For 'Goods Received Note', use the 'GRN No.'.
-        - For 'Delivery Challan', use the number after '(MTS)'.
-        - For 'Diesel Receipt & Issue', use 'S.No.'.
-        - For 'Receipt Memo', find the main memo number (e.g., 58653).
-        - If no clear serial number is found, use the value 'N/A'.
-        Please return a single, raw JSON object with three keys: "documentType" , "serialNumber" and "site". Do not add any extra text, formatting, or markdown.
-        """
-
         mime_type, _ = mimetypes.guess_type(file_path)
         if not mime_type or not mime_type.startswith("image/"):
             print(f"Skipping non-image file: {file_path}")
             return None
 
-        image_file = genai.upload_file(path=file_path)
-
-        response = model.generate_content(
-            [prompt, image_file],
-            generation_config=genai.types.GenerationConfig(
-                response_mime_type="application/json"
-            )
-        )
+        if resize or os.path.getsize(file_path) <= MAX_INLINE_BYTES:
+            # Read the file once and use the same bytes for the cache key and the request
+            image_bytes, file_hash = cache.load_file(file_path)
+        else:
+            # Too big to send inline, so it is uploaded from disk; only stream it through the hash
+            image_bytes, file_hash = None, cache.hash_file(file_path)
+
+        if result_cache is not None:
+            data = result_cache.get(file_hash)
+            if data is not None:
+                print(f"  -> Cached: Type='{data['documentType']}', S/N='{data['serialNumber']}',site='{data.get('site')}'")
+                return data
+
+        uploaded_file = None
+        image_part = None
+        if image_bytes is not None:
+            data, data_mime_type = prepare_image(image_bytes, mime_type, resize)
+            if len(data) <= MAX_INLINE_BYTES:
+                # Send the bytes with the request: one round-trip and nothing to clean up
+                image_part = {"mime_type": data_mime_type, "data": data}
+        if image_part is None:
+            image_part = uploaded_file = genai.upload_file(path=file_path)
+
+        response = generate_with_retry(_MODEL, [_PROMPT, image_part], limiter)
         
         # Clean up the uploaded file on the server
-        genai.delete_file(image_file.name)
+        if uploaded_file is not None:
+            genai.delete_file(uploaded_file.name)
 
-        data = json.loads(response.text)
+        data = orjson.loads(response.text)
         
         if "documentType" in data and "serialNumber" in data:
             print(f"  -> Detected: Type='{data['documentType']}', S/N='{data['serialNumber']}',site='{data['site']}'")
+            # Only cache answers good enough to sort, so a failed file can be retried later
+            if result_cache is not None and is_sortable(data):
+                result_cache.put(file_hash, data)
             return data
         else:
             print(f"  -> Error: API response JSON did not contain the required keys.")
@@ -69,56 +100,95 @@ def analyze_document_image(file_path):
         print(f"  -> Error during Gemini API call: {e}")
         return None
 
-def process_folder(input_dir, output_dir):
+def process_folder(input_dir, output_dir, resize=True, rpm=None):
     """Processes all images in a folder, renames, moves, and sorts them."""
     if not os.path.isdir(input_dir):
         print(f"Error: Input directory '{input_dir}' not found.")
         return
 
-    os.makedirs(output_dir, exist_ok=True)
     print(f"\nProcessing files from: {input_dir}")
+
+    # scandir's DirEntry.is_file() reuses the file type from the directory listing,
+    # so no extra stat call is needed per file
+    with os.scandir(input_dir) as entries:
+        all_files = [entry.path for entry in entries if entry.is_file()]
+
+    process_files(all_files, output_dir, resize, rpm)
+    print(f"The original input folder '{input_dir}' should now be empty.")
+    print(f"Check the '{output_dir}' directory for your sorted files.")
+
+def process_files(file_paths, output_dir, resize=True, rpm=None):
+    """
+    Processes the given files, renames, moves, and sorts them. Every path must be an
+    existing file; callers working from older information (such as the watcher) check first.
+    With rpm set, no more than rpm Gemini requests start in any minute.
+    """
+    os.makedirs(output_dir, exist_ok=True)
     print(f"Moving sorted files to: {output_dir}\n")
 
-    files_to_process = [f for f in os.listdir(input_dir) if os.path.isfile(os.path.join(input_dir, f))]
-    total_files = len(files_to_process)
+    # Split off non-image files up front so they never take up an analysis slot
+    files_to_process = []
+    non_image_files = []
+    for path in file_paths:
+        if is_image(path):
+            files_to_process.append(path)
+        else:
+            non_image_files.append(path)
     success_count = 0
     fail_count = 0
-
-    for filename in files_to_process:
-        source_path = os.path.join(input_dir, filename)
-        result = analyze_document_image(source_path)
-
-        if result and result.get('documentType') != 'Unknown' and result.get('serialNumber') != 'N/A':
+    result_cache = cache.ResultCache(output_dir)
+    limiter = RateLimiter(rpm)
+    # Remember which folders already exist so makedirs runs once per folder, not once per file
+    created_dirs = set()
+    error_dir = os.path.join(output_dir, '_failed_to_process')
+
+    if non_image_files:
+        os.makedirs(error_dir, exist_ok=True)
+        created_dirs.add(error_dir)
+    for source_path in non_image_files:
+        filename = os.path.basename(source_path)
+        print(f"Skipping non-image file: {filename}. Moving to failed folder.\n")
+        fast_move(source_path, os.path.join(error_dir, filename))
+        fail_count += 1
+
+    for source_path in files_to_process:
+        filename = os.path.basename(source_path)
+        result = analyze_document_image(source_path, result_cache, resize, limiter)
+
+        if is_sortable(result):
             doc_type = result['documentType']
             serial_num = result['serialNumber']
             
             sanitized_type = doc_type.replace(' ', '_').lower()
-            sanitized_serial = ''.join(c for c in str(serial_num) if c.isalnum())
+            sanitized_serial = NON_ALNUM.sub('', str(serial_num))
             
             type_dir = os.path.join(output_dir, sanitized_type)
-            os.makedirs(type_dir, exist_ok=True)
+            if type_dir not in created_dirs:
+                os.makedirs(type_dir, exist_ok=True)
+                created_dirs.add(type_dir)
             
             _, extension = os.path.splitext(filename)
             new_filename = f"{sanitized_type}_{sanitized_serial}{extension}"
             destination_path = os.path.join(type_dir, new_filename)
             
             # --- CHANGE: Move the file instead of copying ---
-            shutil.move(source_path, destination_path)
+            fast_move(source_path, destination_path)
             print(f"  -> Success: Moved to {destination_path}\n")
             success_count += 1
         else:
             # --- CHANGE: Move failed files to a separate directory ---
             print(f"  -> Failed: Could not process '{filename}' correctly. Moving to failed folder.\n")
             fail_count += 1
-            error_dir = os.path.join(output_dir, '_failed_to_process')
-            os.makedirs(error_dir, exist_ok=True)
-            shutil.move(source_path, os.path.join(error_dir, filename))
+            if error_dir not in created_dirs:
+                os.makedirs(error_dir, exist_ok=True)
+                created_dirs.add(error_dir)
+            fast_move(source_path, os.path.join(error_dir, filename))
+
+    result_cache.close()
 
     print("--- Processing Complete ---")
     print(f"Successfully moved and sorted: {success_count} files.")
     print(f"Failed or skipped: {fail_count} files (moved to '_failed_to_process' folder).")
-    print(f"The original input folder '{input_dir}' should now be empty.")
-    print(f"Check the '{output_dir}' directory for your sorted files.")
 
 def main():
     """Main function to parse arguments and start the process."""
@@ -146,10 +216,23 @@ To specify a different output folder, use the -o flag:
         default="sorted_documents",
         help="The folder where sorted files will be saved. (default: sorted_documents)"
     )
+    parser.add_argument(
+        "--no-resize",
+        action="store_true",
+        help="Send images at their original size instead of downscaling them first."
+    )
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=None,
+        help="Maximum Gemini requests per minute, e.g. 15 for the free tier. (default: no limit)"
+    )
     args = parser.parse_args()
+    if args.rpm is not None and args.rpm < 1:
+        parser.error("--rpm must be at least 1.")
     
     setup_gemini()
-    process_folder(args.input_directory, args.output_directory)
+    process_folder(args.input_directory, args.output_directory, resize=not args.no_resize, rpm=args.rpm)
 
 if __name__ == "__main__":
     main()
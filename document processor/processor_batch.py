@@ -1,15 +1,59 @@
 import os
-import shutil
+import sqlite3
 import argparse
-import json
+import orjson
 import mimetypes
+import asyncio # Import the async library
+import concurrent.futures
 import google.generativeai as genai
 from dotenv import load_dotenv
-import concurrent.futures # Import the concurrency library
+
+import cache
+from common import (
+    MAX_INLINE_BYTES, NON_ALNUM, AsyncRateLimiter, fast_move, generate_with_retry_async, is_image,
+    is_sortable, prepare_image
+)
+
+# How many inline images to send in one Gemini request.
+# A batch is also capped at MAX_INLINE_BYTES in total, counted after downscaling.
+BATCH_SIZE = 8
+
+# How many chunks per concurrent request may be read and downscaled ahead of the API calls.
+# This keeps the next requests ready without holding the whole folder in memory.
+READ_AHEAD_CHUNKS = 2
 
 # Load environment variables from a .env file
 load_dotenv()
 
+# Define how many requests can be in flight at the same time.
+# Set GEMINI_MAX_CONCURRENCY in .env to match your API quota; setup_gemini() reads it.
+MAX_CONCURRENCY = 16
+
+# Created once by setup_gemini() and shared by every analysis call
+_MODEL = None
+
+_PROMPT_RULES = """
+    Analyze the provided document image. Your task is to classify the document and extract its serial number and the site where it has been issued.
+    site will be handwritten in feild or a space or a box designated for writing.it is usually with names of ATR,MRS,WTP,STP ,NSTP,KOY,KOD,PY and also accomponied by number such as 60,54,120,110,48 do also note that
+    The possible document types are: 'Receipt Memo', 'Cement Issue', 'Diesel Issue', 'Goods Received Note', 'Oil Issue', 'Delivery Challan', or 'Unknown'.
+    The serial number should be the most prominent identification number on the form.
+    - For 'Goods Received Note', use the 'GRN No.'.
+    - For 'Delivery Challan', use the number after '(MTS)'.
+    - For 'Diesel Receipt & Issue', use 'S.No.'.
+    - For 'Receipt Memo', find the main memo number (e.g., 58653).
+    - If no clear serial number is found, use the value 'N/A'.
+"""
+
+_PROMPT = _PROMPT_RULES + """
+    Please return a single, raw JSON object with three keys: "documentType" , "serialNumber" and "site". Do not add any extra text, formatting, or markdown.
+    """
+
+_PROMPT_BATCH = _PROMPT_RULES + """
+    Several document images are provided. Apply the rules above to each image separately.
+    Please return a raw JSON array with exactly one object per image, in the same order as the images.
+    Each object must have four keys: "index" (the 0-based position of the image), "documentType", "serialNumber" and "site". Do not add any extra text, formatting, or markdown.
+    """
+
 def setup_gemini():
     """Configures the Gemini API with the key from environment variables."""
     api_key = os.getenv("API_KEY")
@@ -19,47 +63,59 @@ def setup_gemini():
         exit(1)
     genai.configure(api_key=api_key)
 
-def analyze_document_image(file_path):
+    global MAX_CONCURRENCY
+    concurrency = os.getenv("GEMINI_MAX_CONCURRENCY", str(MAX_CONCURRENCY)).strip()
+    if not concurrency.isdigit() or int(concurrency) < 1:
+        print(f"Error: GEMINI_MAX_CONCURRENCY must be a whole number of at least 1, not '{concurrency}'.")
+        exit(1)
+    MAX_CONCURRENCY = int(concurrency)
+
+    global _MODEL
+    # Use the latest, most cost-effective model with vision capabilities
+    _MODEL = genai.GenerativeModel('gemini-1.5-flash-latest')
+
+def _load_image(file_path, resize=True):
+    """
+    Reads an image from disk once and returns (file_hash, image_part). image_part is the
+    inline part to send to Gemini, or None if the file has to go through the File API.
+    """
+    if not resize and os.path.getsize(file_path) > MAX_INLINE_BYTES:
+        # It will be uploaded straight from disk, so only stream it through the hash
+        return cache.hash_file(file_path), None
+    data, file_hash = cache.load_file(file_path)
+    mime_type, _ = mimetypes.guess_type(file_path)
+    data, mime_type = prepare_image(data, mime_type, resize)
+    if len(data) > MAX_INLINE_BYTES:
+        return file_hash, None
+    return file_hash, {"mime_type": mime_type, "data": data}
+
+async def analyze_document_image(file_path, image_part, cleanup_tasks, limiter=None):
     """
     Analyzes a document image using the Gemini API to get its type and serial number.
-    (This function remains unchanged, as it's a perfect 'worker' function.)
+    image_part is the inline part from _load_image; if it is None the file goes through the
+    File API, and its server-side deletion is scheduled onto cleanup_tasks instead of being
+    awaited, so it never blocks the result. Every attempt waits for limiter, if given.
     """
     print(f"Analyzing {os.path.basename(file_path)}...")
     try:
-        # Use the latest, most cost-effective model with vision capabilities
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
-
-        prompt = """
-        Analyze the provided document image. Your task is to classify the document and extract its serial number and the site where it has been issued.
-        site will be handwritten in feild or a space or a box designated for writing.it is usually with names of ATR,MRS,WTP,STP ,NSTP,KOY,KOD,PY and also accomponied by number such as 60,54,120,110,48 do also note that
-        The possible document types are: 'Receipt Memo', 'Cement Issue', 'Diesel Issue', 'Goods Received Note', 'Oil Issue', 'Delivery Challan', or 'Unknown'.
-        The serial number should be the most prominent identification number on the form.
-        - For 'Goods Received Note', use the 'GRN No.'.
-        - For 'Delivery Challan', use the number after '(MTS)'.
-        - For 'Diesel Receipt & Issue', use 'S.No.'.
-        - For 'Receipt Memo', find the main memo number (e.g., 58653).
-        - If no clear serial number is found, use the value 'N/A'.
-        Please return a single, raw JSON object with three keys: "documentType" , "serialNumber" and "site". Do not add any extra text, formatting, or markdown.
-        """
-
         mime_type, _ = mimetypes.guess_type(file_path)
         if not mime_type or not mime_type.startswith("image/"):
             print(f"Skipping non-image file: {file_path}")
             return None
 
-        image_file = genai.upload_file(path=file_path)
+        uploaded_file = None
+        if image_part is None:
+            # Too large to send inline. The SDK has no async upload, so run it on a worker thread
+            image_part = uploaded_file = await asyncio.to_thread(genai.upload_file, path=file_path)
 
-        response = model.generate_content(
-            [prompt, image_file],
-            generation_config=genai.types.GenerationConfig(
-                response_mime_type="application/json"
-            )
-        )
-        
-        # Clean up the uploaded file on the server
-        genai.delete_file(image_file.name)
+        try:
+            response = await generate_with_retry_async(_MODEL, [_PROMPT, image_part], limiter)
+        finally:
+            # Clean up the uploaded file on the server without waiting for it
+            if uploaded_file is not None:
+                cleanup_tasks.append(asyncio.create_task(asyncio.to_thread(genai.delete_file, uploaded_file.name)))
 
-        data = json.loads(response.text)
+        data = orjson.loads(response.text)
         
         # Use .get() for safer dictionary access
         doc_type = data.get('documentType', 'Unknown')
@@ -73,9 +129,243 @@ def analyze_document_image(file_path):
         print(f"  -> Error during Gemini API call for {os.path.basename(file_path)}: {e}")
         return None
 
-def process_folder(input_dir, output_dir):
+async def analyze_document_batch(file_paths, image_parts, limiter=None):
+    """
+    Analyzes several inline document images (image_parts, from _load_image) with a single
+    Gemini request. Every attempt waits for limiter, if given.
+    Returns a list of results in the same order as file_paths. An entry is None when the
+    model gave no usable answer for that image, so the caller can retry it on its own.
+    """
+    print(f"Analyzing batch of {len(file_paths)}: {', '.join(os.path.basename(p) for p in file_paths)}...")
+    results = [None] * len(file_paths)
+    try:
+        response = await generate_with_retry_async(_MODEL, [_PROMPT_BATCH] + image_parts, limiter)
+
+        items = orjson.loads(response.text)
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            raise ValueError("API response JSON was not an array of objects.")
+        if len(items) != len(file_paths):
+            raise ValueError(f"Expected {len(file_paths)} results but got {len(items)}.")
+
+        # Match each object back to its image. Only trust the indices if they are exactly
+        # 0..n-1; if the model left them all out, fall back to the order of the array.
+        # Anything else could pair a file with another file's serial number, so the whole
+        # batch is dropped and every file is retried on its own.
+        indices = [item.get('index') for item in items]
+        if all(index is None for index in indices):
+            ordered = items
+        elif all(type(index) is int for index in indices) and sorted(indices) == list(range(len(items))):
+            ordered = [None] * len(items)
+            for item in items:
+                ordered[item['index']] = item
+        else:
+            raise ValueError(f"Result indices {indices} don't match the {len(file_paths)} images sent.")
+
+        # An object without both keys counts as no answer for that image
+        results = [
+            item if 'documentType' in item and 'serialNumber' in item else None
+            for item in ordered
+        ]
+
+        for file_path, data in zip(file_paths, results):
+            if data is None:
+                print(f"  -> Error: No batch result for {os.path.basename(file_path)}.")
+                continue
+            doc_type = data.get('documentType', 'Unknown')
+            serial_num = data.get('serialNumber', 'N/A')
+            site = data.get('site', 'N/A')
+            print(f"  -> Detected ({os.path.basename(file_path)}): Type='{doc_type}', S/N='{serial_num}', site='{site}'")
+
+    except Exception as e:
+        print(f"  -> Error during batched Gemini API call: {e}")
+
+    return results
+
+def _chunk_files(file_paths, resize=True):
     """
-    Processes all images concurrently, renames, moves, and sorts them.
+    Groups images into chunks of up to BATCH_SIZE files. With resize off the bytes sent are
+    the bytes on disk, so a chunk is also kept under MAX_INLINE_BYTES in total and images
+    too large to send inline get a chunk of their own. With resize on, sizes are only known
+    after downscaling, so _split_by_size() caps each request once the chunk is loaded.
+    """
+    if resize:
+        return [file_paths[i:i + BATCH_SIZE] for i in range(0, len(file_paths), BATCH_SIZE)]
+
+    chunks = []
+    current = []
+    current_bytes = 0
+    for file_path in file_paths:
+        size = os.path.getsize(file_path)
+        if size > MAX_INLINE_BYTES:
+            chunks.append([file_path])
+            continue
+        if current and (len(current) == BATCH_SIZE or current_bytes + size > MAX_INLINE_BYTES):
+            chunks.append(current)
+            current = []
+            current_bytes = 0
+        current.append(file_path)
+        current_bytes += size
+    if current:
+        chunks.append(current)
+    return chunks
+
+def _split_by_size(indices, image_parts):
+    """
+    Splits the indices of inline images into groups whose prepared bytes add up to no more
+    than MAX_INLINE_BYTES, so each group fits in a single request.
+    """
+    groups = []
+    current = []
+    current_bytes = 0
+    for i in indices:
+        size = len(image_parts[i]["data"])
+        if current and current_bytes + size > MAX_INLINE_BYTES:
+            groups.append(current)
+            current = []
+            current_bytes = 0
+        current.append(i)
+        current_bytes += size
+    if current:
+        groups.append(current)
+    return groups
+
+async def _process_all(output_dir, error_dir, files_to_process, result_cache, resize=True, rpm=None):
+    """
+    Analyzes all files concurrently on one event loop, batching small images into shared
+    requests and answering previously seen images from result_cache, and moves each file
+    as soon as its analysis completes.
+    Returns (success_count, fail_count).
+    """
+    success_count = 0
+    fail_count = 0
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    limiter = AsyncRateLimiter(rpm)
+    cleanup_tasks = []
+    # Remember which folders already exist so makedirs runs once per folder, not once per file.
+    # Moves all happen on the event loop thread, so this needs no lock.
+    created_dirs = {error_dir}
+
+    # Read, hash and downscale files on a dedicated pool, so disk and Pillow work overlaps
+    # with the API calls instead of competing with them for the default to_thread workers.
+    # Each file is read once; its bytes feed both the cache key and the request.
+    # Only READ_AHEAD_CHUNKS chunks are held in memory at a time, however big the folder is.
+    loop = asyncio.get_running_loop()
+    load_pool = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
+    read_ahead = asyncio.Semaphore(READ_AHEAD_CHUNKS * MAX_CONCURRENCY)
+
+    async def analyze_single(source_path, image_part):
+        async with semaphore:
+            return await analyze_document_image(source_path, image_part, cleanup_tasks, limiter)
+
+    async def analyze_chunk(chunk):
+        # Wait for room in the read-ahead window before loading this chunk's images;
+        # the slot is given back once its results are in and the bytes can be freed
+        async with read_ahead:
+            results = [None] * len(chunk)
+            hashes = [None] * len(chunk)
+            image_parts = [None] * len(chunk)
+            pending = []
+
+            loaded = await asyncio.gather(
+                *(loop.run_in_executor(load_pool, _load_image, source_path, resize) for source_path in chunk),
+                return_exceptions=True
+            )
+            # Answer images seen before from the cache and only send the rest to Gemini
+            for i, outcome in enumerate(loaded):
+                if isinstance(outcome, Exception):
+                    print(f"  -> Error reading {os.path.basename(chunk[i])}: {outcome}")
+                    continue
+                hashes[i], image_parts[i] = outcome
+                try:
+                    results[i] = result_cache.get(hashes[i])
+                except sqlite3.Error as e:
+                    # e.g. "database is locked" while the watcher writes; ask Gemini instead
+                    print(f"  -> Warning: Could not read the cache for {os.path.basename(chunk[i])}: {e}")
+                if results[i] is not None:
+                    print(f"  -> Cached ({os.path.basename(chunk[i])}): Type='{results[i]['documentType']}', S/N='{results[i]['serialNumber']}', site='{results[i].get('site', 'N/A')}'")
+                else:
+                    pending.append(i)
+
+            inline = [i for i in pending if image_parts[i] is not None]
+            for group in _split_by_size(inline, image_parts):
+                if len(group) < 2:
+                    continue
+                async with semaphore:
+                    batch_results = await analyze_document_batch(
+                        [chunk[i] for i in group], [image_parts[i] for i in group], limiter
+                    )
+                for i, result in zip(group, batch_results):
+                    results[i] = result
+
+            # Fall back to one request per file for anything the batch did not answer
+            missing = [i for i in pending if results[i] is None]
+            retried = await asyncio.gather(*(analyze_single(chunk[i], image_parts[i]) for i in missing))
+            for i, result in zip(missing, retried):
+                results[i] = result
+
+            # Only cache answers good enough to sort, so a failed file can be retried later
+            for i in pending:
+                if is_sortable(results[i]):
+                    try:
+                        result_cache.put(hashes[i], results[i])
+                    except sqlite3.Error as e:
+                        print(f"  -> Warning: Could not cache the result for {os.path.basename(chunk[i])}: {e}")
+            return chunk, results
+
+    chunks = _chunk_files(files_to_process, resize)
+    print(f"Sending {len(files_to_process)} files in {len(chunks)} requests...\n")
+    tasks = [analyze_chunk(chunk) for chunk in chunks]
+
+    try:
+        # Process the results as they are completed
+        for next_done in asyncio.as_completed(tasks):
+            chunk, results = await next_done
+            for source_path, result in zip(chunk, results):
+                filename = os.path.basename(source_path)
+
+                try:
+                    if is_sortable(result):
+                        doc_type = result['documentType']
+                        serial_num = result['serialNumber']
+                
+                        sanitized_type = doc_type.replace(' ', '_').lower()
+                        sanitized_serial = NON_ALNUM.sub('', str(serial_num))
+                
+                        type_dir = os.path.join(output_dir, sanitized_type)
+                        if type_dir not in created_dirs:
+                            os.makedirs(type_dir, exist_ok=True)
+                            created_dirs.add(type_dir)
+                
+                        _, extension = os.path.splitext(filename)
+                        new_filename = f"{sanitized_type}_{sanitized_serial}{extension}"
+                        destination_path = os.path.join(type_dir, new_filename)
+                
+                        fast_move(source_path, destination_path)
+                        print(f"  -> Success: Moved '{filename}' to {destination_path}\n")
+                        success_count += 1
+                    else:
+                        print(f"  -> Failed: Could not process '{filename}' correctly. Moving to failed folder.\n")
+                        fast_move(source_path, os.path.join(error_dir, filename))
+                        fail_count += 1
+                except Exception as exc:
+                    # Catch any unexpected errors from the file operations
+                    print(f"  -> An exception occurred while handling '{filename}': {exc}. Moving to failed folder.\n")
+                    fast_move(source_path, os.path.join(error_dir, filename))
+                    fail_count += 1
+    finally:
+        # Even if something above fails, stop the loader threads and let the pending
+        # server-side deletions finish before the event loop closes
+        load_pool.shutdown()
+        outcomes = await asyncio.gather(*cleanup_tasks, return_exceptions=True)
+        for outcome in outcomes:
+            if isinstance(outcome, Exception):
+                print(f"  -> Warning: Could not delete an uploaded file from the server: {outcome}")
+
+    return success_count, fail_count
+
+def process_folder(input_dir, output_dir, resize=True, rpm=None):
+    """
+    Processes all images concurrently with asyncio, renames, moves, and sorts them.
     """
     if not os.path.isdir(input_dir):
         print(f"Error: Input directory '{input_dir}' not found.")
@@ -85,64 +375,33 @@ def process_folder(input_dir, output_dir):
     error_dir = os.path.join(output_dir, '_failed_to_process')
     os.makedirs(error_dir, exist_ok=True)
 
-    files_to_process = [f for f in os.listdir(input_dir) if os.path.isfile(os.path.join(input_dir, f))]
-    total_files = len(files_to_process)
+    # scandir's DirEntry.is_file() reuses the file type from the directory listing,
+    # so no extra stat call is needed per file
+    with os.scandir(input_dir) as entries:
+        all_files = [entry.path for entry in entries if entry.is_file()]
+    # Split off non-image files up front so they never take up an analysis slot
+    files_to_process = [path for path in all_files if is_image(path)]
+    non_image_files = [path for path in all_files if not is_image(path)]
+    total_files = len(all_files)
     if total_files == 0:
         print("No files to process in the input directory.")
         return
 
-    success_count = 0
-    fail_count = 0
-
-    # Define how many files to process at the same time.
-    # A value of 5-10 is a good starting point.
-    MAX_WORKERS = 5
-    print(f"\nProcessing {total_files} files with up to {MAX_WORKERS} parallel workers...\n")
-    
-    # Use ThreadPoolExecutor to manage concurrent jobs
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        # Create a dictionary to map a future object to its original file path
-        future_to_path = {
-            executor.submit(analyze_document_image, os.path.join(input_dir, filename)): os.path.join(input_dir, filename)
-            for filename in files_to_process
-        }
+    for source_path in non_image_files:
+        filename = os.path.basename(source_path)
+        print(f"Skipping non-image file: {filename}. Moving to failed folder.")
+        fast_move(source_path, os.path.join(error_dir, filename))
 
-        # Process the results as they are completed
-        for future in concurrent.futures.as_completed(future_to_path):
-            source_path = future_to_path[future]
-            filename = os.path.basename(source_path)
-
-            try:
-                # Get the result from the completed task
-                result = future.result()
-
-                if result and result.get('documentType') != 'Unknown' and result.get('serialNumber') != 'N/A':
-                    doc_type = result['documentType']
-                    serial_num = result['serialNumber']
-                    
-                    sanitized_type = doc_type.replace(' ', '_').lower()
-                    sanitized_serial = ''.join(c for c in str(serial_num) if c.isalnum())
-                    
-                    type_dir = os.path.join(output_dir, sanitized_type)
-                    os.makedirs(type_dir, exist_ok=True)
-                    
-                    _, extension = os.path.splitext(filename)
-                    new_filename = f"{sanitized_type}_{sanitized_serial}{extension}"
-                    destination_path = os.path.join(type_dir, new_filename)
-                    
-                    shutil.move(source_path, destination_path)
-                    print(f"  -> Success: Moved '{filename}' to {destination_path}\n")
-                    success_count += 1
-                else:
-                    print(f"  -> Failed: Could not process '{filename}' correctly. Moving to failed folder.\n")
-                    shutil.move(source_path, os.path.join(error_dir, filename))
-                    fail_count += 1
-            except Exception as exc:
-                # Catch any unexpected errors from the analysis or file operations
-                print(f"  -> An exception occurred while handling '{filename}': {exc}. Moving to failed folder.\n")
-                shutil.move(source_path, os.path.join(error_dir, filename))
-                fail_count += 1
+    print(f"\nProcessing {len(files_to_process)} images with up to {MAX_CONCURRENCY} concurrent requests...\n")
 
+    result_cache = cache.ResultCache(output_dir)
+    try:
+        success_count, fail_count = asyncio.run(
+            _process_all(output_dir, error_dir, files_to_process, result_cache, resize, rpm)
+        )
+    finally:
+        result_cache.close()
+    fail_count += len(non_image_files)
 
     print("--- Processing Complete ---")
     print(f"Successfully moved and sorted: {success_count} files.")
@@ -176,10 +435,23 @@ To specify a different output folder, use the -o flag:
         default="sorted_documents",
         help="The folder where sorted files will be saved. (default: sorted_documents)"
     )
+    parser.add_argument(
+        "--no-resize",
+        action="store_true",
+        help="Send images at their original size instead of downscaling them first."
+    )
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=None,
+        help="Maximum Gemini requests per minute, e.g. 15 for the free tier. (default: no limit)"
+    )
     args = parser.parse_args()
+    if args.rpm is not None and args.rpm < 1:
+        parser.error("--rpm must be at least 1.")
     
     setup_gemini()
-    process_folder(args.input_directory, args.output_directory)
+    process_folder(args.input_directory, args.output_directory, resize=not args.no_resize, rpm=args.rpm)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,13 +1,15 @@
 # watcher.py
 import os
 import sys
-import time
 import logging
+import threading
 import argparse
-import subprocess
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
+import processor
+from common import is_image
+
 # --- Set up logging ---
 # This configures how messages are displayed (timestamp, level, message)
 logging.basicConfig(
@@ -16,77 +18,151 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
+# Partial files written by browsers, sync clients and editors; the finished file shows up later
+IGNORED_SUFFIXES = ('.tmp', '.part', '.crdownload', '.swp')
+
 class FileCreatedEventHandler(FileSystemEventHandler):
     """
-    Handles file creation events and triggers a processor script after a debounce period.
+    Handles file creation events and runs the processor on the new files after a debounce period.
     """
-    def __init__(self, processor_script, watch_path, output_path, debounce_seconds=60):
+    def __init__(self, watch_path, output_path, debounce_seconds=60, rpm=None):
         """
         Initializes the event handler.
         
         Args:
-            processor_script (str): The path to the processor script to run.
             watch_path (str): The directory being watched.
             output_path (str): The directory for processed output.
             debounce_seconds (int): How long to wait after the last file creation.
+            rpm (int): Maximum Gemini requests per minute, or None for no limit.
         """
-        self.processor_script = processor_script
         self.watch_path = watch_path
         self.output_path = output_path
         self.debounce_seconds = debounce_seconds
-        self.last_triggered_time = 0
+        self.rpm = rpm
+        self._timer = None
+        # Guards both the timer and the set of files waiting for the next run
+        self._lock = threading.Lock()
+        self._pending = set()
+        # Serializes processor runs in case a new timer fires while a batch is still running
+        self._run_lock = threading.Lock()
+        # Set by shutdown(); no new runs start after that
+        self._stopping = False
+
+    @staticmethod
+    def _is_wanted(path):
+        """
+        Returns True for files the processor should see, ignoring hidden and
+        temporary/partial files that will be replaced by the finished file.
+        """
+        return not (path.endswith(IGNORED_SUFFIXES) or os.path.basename(path).startswith('.'))
+
+    def queue_existing_files(self):
+        """
+        Queues files already in the watched directory, so they are processed
+        together with the first batch of new files.
+        """
+        with os.scandir(self.watch_path) as entries:
+            paths = [entry.path for entry in entries if entry.is_file() and self._is_wanted(entry.path)]
+        with self._lock:
+            self._pending.update(paths)
+
+    def _reset_timer(self, path, reason):
+        """
+        Queues path for the next run. Images restart the debounce timer; other files are
+        only moved to the failed folder with the next run, so they don't hold it back.
+        """
+        with self._lock:
+            if self._stopping:
+                return
+            self._pending.add(path)
+            if self._timer and not is_image(path):
+                logging.info(f"File {reason}: {path}. Queued for the next run.")
+                return
+            logging.info(f"File {reason}: {path}. Resetting debounce timer.")
+            # Replace any pending timer so processing starts debounce_seconds after the last event
+            if self._timer:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.debounce_seconds, self._fire)
+            self._timer.daemon = True
+            self._timer.start()
 
     def on_created(self, event):
         """
         Called by watchdog when a file or directory is created.
         """
-        # We only care about files, not new directories
-        if not event.is_directory:
-            logging.info(f"File created: {event.src_path}. Resetting debounce timer.")
-            # Record the time of this event
-            self.last_triggered_time = time.time()
+        # We only care about files, not new directories or partial downloads
+        if not event.is_directory and self._is_wanted(event.src_path):
+            self._reset_timer(event.src_path, "created")
+
+    def on_closed(self, event):
+        """
+        Called by watchdog when a file opened for writing is closed (Linux only, watchdog >= 2.1).
+        This marks the end of a copy, so the timer restarts from when the file is complete.
+        """
+        if not event.is_directory and self._is_wanted(event.src_path):
+            self._reset_timer(event.src_path, "written")
 
-    def run_processor_if_ready(self):
+    def on_moved(self, event):
         """
-        Checks if the debounce period has passed and then runs the processor script.
-        This method should be called periodically (e.g., every second).
+        Called by watchdog when a file is renamed, e.g. a finished '.crdownload' becoming '.jpg'.
         """
-        # Check if the trigger has been set and if enough time has passed
-        if self.last_triggered_time > 0 and (time.time() - self.last_triggered_time) > self.debounce_seconds:
-            logging.info(f"Debounce time of {self.debounce_seconds}s passed. Running processor script.")
+        if not event.is_directory and self._is_wanted(event.dest_path):
+            self._reset_timer(event.dest_path, "renamed")
+
+    def _fire(self):
+        """
+        Runs the processor once the debounce timer expires.
+        This method is called on the timer's thread.
+        """
+        with self._run_lock:
+            # Take the queued files; anything arriving from now on waits for the next run
+            with self._lock:
+                if self._stopping:
+                    return
+                # A newer event replaced this timer while it waited behind a running batch;
+                # leave the queued files to the newer timer, whose debounce hasn't run out yet
+                if self._timer is not None and self._timer is not threading.current_thread():
+                    return
+                batch = list(self._pending)
+                self._pending.clear()
+                # This timer has fired, so the next file has to start a new one
+                self._timer = None
+            # A queued file may have been moved or deleted since its event
+            batch = [path for path in batch if os.path.isfile(path)]
+            if not batch:
+                return
+            logging.info(f"Debounce time of {self.debounce_seconds}s passed. Running processor on {len(batch)} new files.")
             
             try:
-                # Use subprocess to call the processor.py script
-                # Pass the watch path and output path as arguments
-                command = [
-                    'python', 
-                    self.processor_script, 
-                    self.watch_path, 
-                    '--output-dir', 
-                    self.output_path
-                ]
-                subprocess.run(command, check=True, capture_output=True, text=True)
-                logging.info("Processor script finished successfully.")
+                # Call the processor in-process so the Gemini client stays warm between batches.
+                # Only the queued files are handed over, so the folder isn't listed again.
+                processor.process_files(batch, self.output_path, rpm=self.rpm)
+                logging.info("Processor finished successfully.")
             
-            except subprocess.CalledProcessError as e:
-                # This error happens if the script returns a non-zero exit code (an error)
-                logging.error(f"Error running processor script: {e}")
-                logging.error(f"Script stderr:\n{e.stderr}")
-
-            except FileNotFoundError:
-                logging.error(f"Script not found: Make sure '{self.processor_script}' is accessible.")
+            except Exception as e:
+                logging.error(f"Error running processor: {e}")
             
             finally:
-                # Reset the trigger time to prevent running again until a new file is created
-                self.last_triggered_time = 0
                 logging.info("Watcher is now waiting for new file events.")
 
+    def shutdown(self):
+        """
+        Cancels any pending debounce timer and waits for a batch that is already running,
+        so the process doesn't exit (and kill the daemon timer thread) halfway through a move.
+        """
+        with self._lock:
+            self._stopping = True
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+        with self._run_lock:
+            pass
 
 def main():
     """Main function to set up and run the directory watcher."""
     # --- Configuration via Command-Line Arguments ---
     parser = argparse.ArgumentParser(
-        description="Watch a directory for new files and run a processor script after a period of inactivity."
+        description="Watch a directory for new files and run the processor after a period of inactivity."
     )
     parser.add_argument(
         '--watch-dir', 
@@ -94,12 +170,6 @@ def main():
         default='my_docs', 
         help="The directory to watch for new files."
     )
-    parser.add_argument(
-        '--processor-script', 
-        type=str, 
-        default='processor.py', 
-        help="The script to run on the files."
-    )
     parser.add_argument(
         '--output-dir', 
         type=str, 
@@ -112,7 +182,15 @@ def main():
         default=60, 
         help="Seconds to wait after the last file creation before processing."
     )
+    parser.add_argument(
+        '--rpm',
+        type=int,
+        default=None,
+        help="Maximum Gemini requests per minute, e.g. 15 for the free tier. (default: no limit)"
+    )
     args = parser.parse_args()
+    if args.rpm is not None and args.rpm < 1:
+        parser.error("--rpm must be at least 1.")
 
     # --- Ensure Directories Exist ---
     # Create the watch and output directories if they don't already exist
@@ -123,30 +201,36 @@ def main():
         logging.error(f"Error creating directories: {e}")
         sys.exit(1)
 
+    # Configure the Gemini client once; it is reused for every batch
+    processor.setup_gemini()
+
     logging.info(f"Watching directory: '{os.path.abspath(args.watch_dir)}'")
     logging.info(f"Press Ctrl+C to stop the watcher.")
 
     # --- Create and Start the Watchdog Observer ---
     event_handler = FileCreatedEventHandler(
-        processor_script=args.processor_script,
         watch_path=args.watch_dir,
         output_path=args.output_dir,
-        debounce_seconds=args.debounce
+        debounce_seconds=args.debounce,
+        rpm=args.rpm
     )
-    
+    # Files left over from before startup are picked up with the first batch
+    event_handler.queue_existing_files()
+
     observer = Observer()
     observer.schedule(event_handler, args.watch_dir, recursive=False)
     observer.start()
 
     # --- Main Loop ---
-    # This loop keeps the script alive and periodically checks if the processor should run.
+    # The debounce timer does the work, so the main thread just waits until shutdown.
+    # The join is timed because an untimed wait can't be interrupted by Ctrl+C on Windows.
     try:
-        while True:
-            event_handler.run_processor_if_ready()
-            time.sleep(1)
+        while observer.is_alive():
+            observer.join(timeout=1)
     except KeyboardInterrupt:
-        logging.info("Watcher stopped by user.")
+        logging.info("Watcher stopped by user. Waiting for any running batch to finish...")
         observer.stop()
+        event_handler.shutdown()
     finally:
         observer.join() # Wait for the observer thread to finish gracefully
 